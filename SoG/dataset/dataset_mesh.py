@@ -24,6 +24,13 @@ class DatasetMesh(torch.utils.data.Dataset):
         self.elevation_range_min= np.deg2rad(FLAGS.elevation_range[0])
         self.elevation_range_max= np.deg2rad(FLAGS.elevation_range[1])
         self.angle_front        = np.deg2rad(FLAGS.front_threshold)
+
+    def __getstate__(self):
+        # The rasterizer context cannot be pickled into DataLoader workers, and cameras do not need it
+        state = self.__dict__.copy()
+        state['glctx'] = None
+        return state
+
     def _gif_scene(self, itr):
         fovy = np.deg2rad(45)
         proj_mtx = util.perspective(fovy, self.FLAGS.display_res[1] / self.FLAGS.display_res[0], self.FLAGS.cam_near_far[0], self.FLAGS.cam_near_far[1])
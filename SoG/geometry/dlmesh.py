@@ -80,6 +80,13 @@ class DLMesh(torch.nn.Module):
                                   if_use_bump = if_use_bump
                                    )
 
+    def render_multi(self, glctx, target, lgt, opt_material, bsdfs, mode = 'appearance_modeling', if_flip_the_normal = False, if_use_bump = False):
+        # Rasterize and sample the material once, then shade with every BSDF in bsdfs
+        buffers = self.render(glctx, target, lgt, opt_material, bsdf=list(bsdfs), mode=mode, if_flip_the_normal=if_flip_the_normal, if_use_bump=if_use_bump)
+        if len(bsdfs) == 1:
+            return {bsdfs[0] : buffers}
+        return {bsdf : {'shaded' : buffers['shaded_%s' % bsdf]} for bsdf in bsdfs}
+
     def tick(self, glctx, target, lgt, opt_material, iteration, if_normal, stable_diffusion, if_flip_the_normal, if_use_bump):
         # ==============================================================================================
         #  Render optimizable object with identical conditions
@@ -88,7 +95,7 @@ class DLMesh(torch.nn.Module):
         if self.FLAGS.add_directional_text:
             text_embeddings = torch.cat([stable_diffusion.uncond_z[target['prompt_index']], stable_diffusion.text_z[target['prompt_index']]])
         else:
-            text_embeddings = torch.cat([stable_diffusion.uncond_z, stable_diffusion.text_z])
+            text_embeddings = stable_diffusion.text_embeddings
             
         if iteration <= self.FLAGS.coarse_iter:
             srgb =  buffers['shaded'][...,0:3]
@@ -101,8 +108,10 @@ class DLMesh(torch.nn.Module):
             # t = torch.randint(stable_diffusion.min_step_late, stable_diffusion.max_step_late, [1], dtype=torch.long, device='cuda')
             t = torch.randint( stable_diffusion.min_step_late, stable_diffusion.max_step_late+1, [self.FLAGS.batch], dtype=torch.long, device='cuda') # [B]
 
-        pred_rgb_512 = srgb.permute(0, 3, 1, 2).contiguous() # [1, 3, H, W]
-        latents = stable_diffusion.encode_imgs(pred_rgb_512)
+        pred_rgb_512 = srgb.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last) # [1, 3, H, W], NHWC in memory so no copy is needed
+        # Only the Stable Diffusion VAE / UNet run under autocast, rendering above stays in FP32
+        with torch.autocast(device_type='cuda', dtype=stable_diffusion.dtype):
+            latents = stable_diffusion.encode_imgs(pred_rgb_512)
        
         with torch.no_grad():
             # add noise
@@ -111,7 +120,8 @@ class DLMesh(torch.nn.Module):
             # pred noise
             latent_model_input = torch.cat([latents_noisy] * 2)
             tt = torch.cat([t] * 2)
-            noise_pred = stable_diffusion.unet(latent_model_input, tt, encoder_hidden_states= text_embeddings).sample
+            with torch.autocast(device_type='cuda', dtype=stable_diffusion.dtype):
+                noise_pred = stable_diffusion.unet(latent_model_input, tt, encoder_hidden_states= text_embeddings).sample
         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
         noise_pred = noise_pred_uncond + stable_diffusion.stable_diffusion_weight * (noise_pred_text - noise_pred_uncond)
     
@@ -84,39 +84,41 @@ def shade(
     assert 'bsdf' in material or bsdf is not None, "Material must specify a BSDF type"
     bsdf = material['bsdf'] if bsdf is None else bsdf
     
-   
-    if bsdf == 'pbr':
-        if mode == 'geometry_modeling':
-            shaded_col = kd * ru.lambert(gb_normal, util.safe_normalize(view_pos - gb_pos)) * 5
-        elif mode == 'appearance_modeling':
-            shaded_col = lgt.shade(gb_pos, gb_normal, kd, ks, view_pos, specular = True)
+    # A list of BSDFs reuses the texture lookups above and outputs one 'shaded_<bsdf>' buffer per BSDF
+    bsdfs = bsdf if isinstance(bsdf, (list, tuple)) else [bsdf]
+    buffers = {}
+    for bsdf in bsdfs:
+        if bsdf == 'pbr':
+            if mode == 'geometry_modeling':
+                shaded_col = kd * ru.lambert(gb_normal, util.safe_normalize(view_pos - gb_pos)) * 5
+            elif mode == 'appearance_modeling':
+                shaded_col = lgt.shade(gb_pos, gb_normal, kd, ks, view_pos, specular = True)
+            else:
+                assert False, "Invalid mode type"
+        elif bsdf == 'diffuse':
+            if mode == 'geometry_modeling':
+                shaded_col = kd * ru.lambert(gb_normal, util.safe_normalize(view_pos - gb_pos)) * 5
+            elif mode == 'appearance_modeling':
+                shaded_col = lgt.shade(gb_pos, gb_normal, kd, ks, view_pos, specular = False)
+            else:
+                assert False, "Invalid mode type"
+        elif bsdf == 'normal':
+            shaded_col = gb_normal1
+            if if_flip_the_normal:
+                shaded_col[...,0][shaded_col[...,0]>0]= shaded_col[...,0][shaded_col[...,0]>0]*(-1) # Flip the x-axis positive half-axis of Normal. I found this process helps to alleviate the Janus problem.
+        elif bsdf == 'tangent':
+            shaded_col = (gb_tangent + 1.0)*0.5
+        elif bsdf == 'kd':
+            shaded_col = kd
+        elif bsdf == 'ks':
+            shaded_col = ks
         else:
-            assert False, "Invalid mode type"
-    elif bsdf == 'diffuse':
-        if mode == 'geometry_modeling':
-            shaded_col = kd * ru.lambert(gb_normal, util.safe_normalize(view_pos - gb_pos)) * 5
-        elif mode == 'appearance_modeling':
-            shaded_col = lgt.shade(gb_pos, gb_normal, kd, ks, view_pos, specular = False)
-        else:
-            assert False, "Invalid mode type"
-    elif bsdf == 'normal':
-        shaded_col = gb_normal1
-        if if_flip_the_normal:
-            shaded_col[...,0][shaded_col[...,0]>0]= shaded_col[...,0][shaded_col[...,0]>0]*(-1) # Flip the x-axis positive half-axis of Normal. I found this process helps to alleviate the Janus problem.
-    elif bsdf == 'tangent':
-        shaded_col = (gb_tangent + 1.0)*0.5
-    elif bsdf == 'kd':
-        shaded_col = kd
-    elif bsdf == 'ks':
-        shaded_col = ks
-    else:
-        assert False, "Invalid BSDF '%s'" % bsdf
-    
-    buffers = {
-        'shaded'    : torch.cat((shaded_col, alpha), dim=-1),
-        # 'kd_grad'   : torch.cat((kd_grad, alpha), dim=-1),
-        # 'occlusion' : torch.cat((ks[..., :1], alpha), dim=-1)  #it is similar to a simple ambient occlusion term and does not account for directional visibility
-    }
+            assert False, "Invalid BSDF '%s'" % bsdf
+        
+        key = 'shaded_%s' % bsdf if len(bsdfs) > 1 else 'shaded'
+        buffers[key] = torch.cat((shaded_col, alpha), dim=-1)
+    # buffers['kd_grad'] = torch.cat((kd_grad, alpha), dim=-1)
+    # buffers['occlusion'] = torch.cat((ks[..., :1], alpha), dim=-1)  #it is similar to a simple ambient occlusion term and does not account for directional visibility
     return buffers
 
 # ==============================================================================================
@@ -269,7 +271,7 @@ def render_mesh(
     # Composite layers front-to-back
     out_buffers = {}
     for key in layers[0][0].keys():
-        if key == 'shaded':
+        if key.startswith('shaded'):
             accum = composite_buffer(key, layers, background, True)
         else:
             accum = composite_buffer(key, layers, torch.zeros_like(layers[0][0][key]), False)
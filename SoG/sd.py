@@ -23,10 +23,12 @@ class StableDiffusion(nn.Module):
                  early_time_step_range = [0.02, 0.5],
                  late_time_step_range = [0.02, 0.5],
                  sd_version = '2.1',
-                 negative_text = ''):
+                 negative_text = '',
+                 dtype = torch.float16):
         super().__init__()
 
         self.device = device
+        self.dtype = dtype
         self.text= text
         self.add_directional_text = add_directional_text
         self.batch = batch 
@@ -38,10 +40,13 @@ class StableDiffusion(nn.Module):
             model_key = "stabilityai/stable-diffusion-2-base"
         elif self.sd_version == '1.5':
             model_key = "runwayml/stable-diffusion-v1-5"
-        self.vae = AutoencoderKL.from_pretrained(model_key, subfolder="vae",torch_dtype=torch.float16).to(self.device)
-        self.tokenizer = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer",torch_dtype=torch.float16 )
-        self.text_encoder = CLIPTextModel.from_pretrained(model_key, subfolder="text_encoder",torch_dtype=torch.float16 ).to(self.device)
-        self.unet = UNet2DConditionModel.from_pretrained(model_key, subfolder="unet",torch_dtype=torch.float16 ).to(self.device)
+        self.vae = AutoencoderKL.from_pretrained(model_key, subfolder="vae",torch_dtype=dtype).to(self.device)
+        self.tokenizer = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer",torch_dtype=dtype )
+        self.text_encoder = CLIPTextModel.from_pretrained(model_key, subfolder="text_encoder",torch_dtype=dtype ).to(self.device)
+        self.unet = UNet2DConditionModel.from_pretrained(model_key, subfolder="unet",torch_dtype=dtype ).to(self.device)
+        # The rendered images are NHWC already, keep the convolutions in the same layout
+        self.vae = self.vae.to(memory_format=torch.channels_last)
+        self.unet = self.unet.to(memory_format=torch.channels_last)
         if is_xformers_available():
             self.unet.enable_xformers_memory_efficient_attention()
         self.negative_text = negative_text
@@ -62,6 +67,8 @@ class StableDiffusion(nn.Module):
         else: 
             self.text_z = self.get_text_embeds([self.text], batch = self.batch)
             self.uncond_z =self.get_uncond_embeds([self.negative_text], batch = self.batch)
+            # Classifier-free guidance input, constant for the whole run without directional text
+            self.text_embeddings = torch.cat([self.uncond_z, self.text_z])
         del self.text_encoder
         self.scheduler = DPMSolverMultistepScheduler.from_pretrained(model_key, subfolder="scheduler", torch_dtype=torch.float16)
         # self.scheduler = DDIMScheduler.from_config(model_key, subfolder="scheduler", torch_dtype=torch.float16)
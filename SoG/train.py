@@ -8,9 +8,11 @@
 # its affiliates is strictly prohibited.
 
 import os
-import time
 import argparse
 import json
+import inspect
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 import nvdiffrast.torch as dr
@@ -32,18 +34,73 @@ import imageio
 ###############################################################################
 @torch.no_grad()
 def prepare_batch(target, background= 'black',it = 0,coarse_iter=0):
-    target['mv'] = target['mv'].cuda()
-    target['mvp'] = target['mvp'].cuda()
-    target['campos'] = target['campos'].cuda()
-    target['normal_rotate'] = target['normal_rotate'].cuda()
+    if 'ready' in target:
+        # Already copied by CudaPrefetcher on its side stream, wait for the copy to land
+        torch.cuda.current_stream().wait_event(target['ready'])
+        for key in CudaPrefetcher.KEYS:
+            target[key].record_stream(torch.cuda.current_stream())
+    else:
+        target['mv'] = target['mv'].cuda()
+        target['mvp'] = target['mvp'].cuda()
+        target['campos'] = target['campos'].cuda()
+        target['normal_rotate'] = target['normal_rotate'].cuda()
     batch_size = target['mv'].shape[0]
     resolution = target['resolution']
-    if background == 'white':
-        target['background']= torch.ones(batch_size, resolution[0], resolution[1], 3, dtype=torch.float32, device='cuda') 
-    if background == 'black':
-        target['background'] = torch.zeros(batch_size, resolution[0], resolution[1], 3, dtype=torch.float32, device='cuda')
+    if background in ('white', 'black'):
+        target['background'] = get_background(background, resolution).expand(batch_size, -1, -1, -1)
     return target
 
+# Constant backgrounds are only read by the renderer, so keep one per color / resolution
+# and hand out expanded views instead of allocating a new batch every iteration
+_BACKGROUNDS = {}
+def get_background(background, resolution):
+    key = (background, resolution[0], resolution[1])
+    if key not in _BACKGROUNDS:
+        fill = torch.ones if background == 'white' else torch.zeros
+        _BACKGROUNDS[key] = fill(1, resolution[0], resolution[1], 3, dtype=torch.float32, device='cuda')
+    return _BACKGROUNDS[key]
+
+###############################################################################
+# Copy the next batch to the GPU while the current one is being trained on
+###############################################################################
+class CudaPrefetcher:
+    KEYS = ('mv', 'mvp', 'campos', 'normal_rotate')
+
+    def __init__(self, loader, stream):
+        self.loader = loader
+        self.stream = stream
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator):
+        target = next(iterator, None)
+        if target is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            for key in self.KEYS:
+                target[key] = target[key].to('cuda', non_blocking=True)
+            target['ready'] = self.stream.record_event()
+        return target
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        target = self._preload(iterator)
+        while target is not None:
+            next_target = self._preload(iterator)
+            yield target
+            target = next_target
+
+# Repeats a dataset forever, so the loader never has to be re-created on wrap-around
+class _InfValidate(torch.utils.data.IterableDataset):
+    def __init__(self, base):
+        self.base = base
+
+    def __iter__(self):
+        while True:
+            for idx in range(len(self.base)):
+                yield self.base[idx]
+
 ###############################################################################
 # UV - map geometry & convert to a mesh
 ###############################################################################
@@ -57,9 +114,9 @@ def xatlas_uvmap(glctx, geometry, mat, FLAGS):
     if FLAGS.layers > 1:
         kd = torch.cat((kd, torch.rand_like(kd[...,0:1])), dim=-1)
 
-    kd_min, kd_max = torch.tensor(FLAGS.kd_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.kd_max, dtype=torch.float32, device='cuda')
-    ks_min, ks_max = torch.tensor(FLAGS.ks_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.ks_max, dtype=torch.float32, device='cuda')
-    nrm_min, nrm_max = torch.tensor(FLAGS.nrm_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.nrm_max, dtype=torch.float32, device='cuda')
+    kd_min, kd_max = FLAGS._kd_min_t, FLAGS._kd_max_t
+    ks_min, ks_max = FLAGS._ks_min_t, FLAGS._ks_max_t
+    nrm_min, nrm_max = FLAGS._nrm_min_t, FLAGS._nrm_max_t
 
     new_mesh.material = material.Material({
         'bsdf'   : mat['bsdf'],
@@ -74,10 +131,15 @@ def xatlas_uvmap(glctx, geometry, mat, FLAGS):
 # Utility functions for material
 ##############################################################################
 
+# Build the material limits as cuda tensors once, instead of on every use
+def _materialize_bounds(FLAGS):
+    for key in ['kd_min', 'kd_max', 'ks_min', 'ks_max', 'nrm_min', 'nrm_max']:
+        setattr(FLAGS, '_%s_t' % key, torch.as_tensor(getattr(FLAGS, key), dtype=torch.float32, device='cuda'))
+
 def init_material(geometry, FLAGS):
-    kd_min, kd_max = torch.tensor(FLAGS.kd_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.kd_max, dtype=torch.float32, device='cuda')
-    ks_min, ks_max = torch.tensor(FLAGS.ks_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.ks_max, dtype=torch.float32, device='cuda')
-    nrm_min, nrm_max = torch.tensor(FLAGS.nrm_min, dtype=torch.float32, device='cuda'), torch.tensor(FLAGS.nrm_max, dtype=torch.float32, device='cuda')
+    kd_min, kd_max = FLAGS._kd_min_t, FLAGS._kd_max_t
+    ks_min, ks_max = FLAGS._ks_min_t, FLAGS._ks_max_t
+    nrm_min, nrm_max = FLAGS._nrm_min_t, FLAGS._nrm_max_t
 
     mlp_min = torch.cat((kd_min[0:3], ks_min, nrm_min), dim=0)
     mlp_max = torch.cat((kd_max[0:3], ks_max, nrm_max), dim=0)
@@ -91,7 +153,7 @@ def init_material(geometry, FLAGS):
 ###############################################################################
 # Validation & testing
 ###############################################################################
-def validate_itr(glctx, target, geometry, opt_material, lgt, FLAGS, relight = None):
+def validate_itr(glctx, target, geometry, opt_material, lgt, FLAGS, relight = None, light_latlong = None):
     result_dict = {}
     with torch.no_grad():
         with torch.no_grad():
@@ -100,40 +162,49 @@ def validate_itr(glctx, target, geometry, opt_material, lgt, FLAGS, relight = No
                 lgt.xfm(target['mv'])
             if relight != None:
                 relight.build_mips()
-        buffers = geometry.render(glctx, target, lgt, opt_material, if_use_bump = FLAGS.if_use_bump)
-        result_dict['shaded'] =  buffers['shaded'][0, ..., 0:3]
+        # Every BSDF shown in the display shares a single rasterization / texture lookup
+        bsdfs = [opt_material['bsdf']]
+        for layer in (FLAGS.display if FLAGS.display is not None else []):
+            if 'bsdf' in layer and layer['bsdf'] not in bsdfs:
+                bsdfs.append(layer['bsdf'])
+        multi_buffers = geometry.render_multi(glctx, target, lgt, opt_material, bsdfs, if_use_bump = FLAGS.if_use_bump)
+        buffers = multi_buffers[opt_material['bsdf']]
+        result_dict['shaded'] =  buffers['shaded'][..., 0:3]
         result_dict['shaded'] = util.rgb_to_srgb(result_dict['shaded'])
         if relight != None:
-            result_dict['relight'] = geometry.render(glctx, target, relight, opt_material, if_use_bump = FLAGS.if_use_bump)['shaded'][0, ..., 0:3]
+            result_dict['relight'] = geometry.render(glctx, target, relight, opt_material, if_use_bump = FLAGS.if_use_bump)['shaded'][..., 0:3]
             result_dict['relight'] = util.rgb_to_srgb(result_dict['relight'])
-        result_dict['mask'] = (buffers['shaded'][0, ..., 3:4])
+        result_dict['mask'] = (buffers['shaded'][..., 3:4])
         result_image = result_dict['shaded']
 
         if FLAGS.display is not None :
             for layer in FLAGS.display:
                 if 'latlong' in layer and layer['latlong']:
                     if isinstance(lgt, light.EnvironmentLight):
-                        result_dict['light_image'] = util.cubemap_to_latlong(lgt.base, FLAGS.display_res)
-                    result_image = torch.cat([result_image, result_dict['light_image']], axis=1)
+                        if light_latlong is None:
+                            light_latlong = util.cubemap_to_latlong(lgt.base, FLAGS.display_res)
+                        result_dict['light_image'] = light_latlong[None, ...].expand(result_image.shape[0], -1, -1, -1)
+                    result_image = torch.cat([result_image, result_dict['light_image']], axis=2)
                 elif 'bsdf' in layer:
-                    buffers  = geometry.render(glctx, target, lgt, opt_material, bsdf=layer['bsdf'],  if_use_bump = FLAGS.if_use_bump)
+                    buffers  = multi_buffers[layer['bsdf']]
                     if layer['bsdf'] == 'kd':
-                        result_dict[layer['bsdf']] = util.rgb_to_srgb(buffers['shaded'][0, ..., 0:3])  
+                        result_dict[layer['bsdf']] = util.rgb_to_srgb(buffers['shaded'][..., 0:3])  
                     elif layer['bsdf'] == 'normal':
-                        result_dict[layer['bsdf']] = (buffers['shaded'][0, ..., 0:3] + 1) * 0.5
+                        result_dict[layer['bsdf']] = (buffers['shaded'][..., 0:3] + 1) * 0.5
                     else:
-                        result_dict[layer['bsdf']] = buffers['shaded'][0, ..., 0:3]
-                    result_image = torch.cat([result_image, result_dict[layer['bsdf']]], axis=1)
+                        result_dict[layer['bsdf']] = buffers['shaded'][..., 0:3]
+                    result_image = torch.cat([result_image, result_dict[layer['bsdf']]], axis=2)
 
         return result_image, result_dict
 
-def save_gif(dir,fps):
-    imgpath = dir
-    frames = []
-    for idx in sorted(os.listdir(imgpath)):
-        # print(idx)
-        img = os.path.join(imgpath,idx)
-        frames.append(imageio.imread(img))
+def save_gif(dir,fps,frames=None):
+    if frames is None:
+        # No frames kept in memory, decode the saved images instead
+        # Frame names are zero padded, so sorting by name gives the frame order
+        with os.scandir(dir) as it:
+            entries = sorted((e for e in it if e.name.endswith('.png')), key=lambda e: e.name)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            frames = list(pool.map(imageio.imread, (e.path for e in entries)))
     imageio.mimsave(os.path.join(dir, 'eval.gif'),frames,'GIF',duration=1/fps)
     
 @torch.no_grad()     
@@ -143,7 +214,9 @@ def validate(glctx, geometry, opt_material, lgt, dataset_validate, out_dir, FLAG
     #  Validation loop
     # ==============================================================================================
 
-    dataloader_validate = torch.utils.data.DataLoader(dataset_validate, batch_size=1, collate_fn=dataset_validate.collate)
+    # Render several views per pass, results are [B, H, W, C] and saved per view
+    batch_size = 8
+    dataloader_validate = torch.utils.data.DataLoader(dataset_validate, batch_size=batch_size, collate_fn=dataset_validate.collate)
 
     os.makedirs(out_dir, exist_ok=True)
     
@@ -161,40 +234,57 @@ def validate(glctx, geometry, opt_material, lgt, dataset_validate, out_dir, FLAG
     os.makedirs(normal_dir, exist_ok=True)
     os.makedirs(mask_dir, exist_ok=True)
     
+    # The light does not change during validation, so its latlong image is only computed once
+    light_latlong = None
+    if FLAGS.display is not None and isinstance(lgt, light.EnvironmentLight) and any('latlong' in layer and layer['latlong'] for layer in FLAGS.display):
+        light_latlong = util.cubemap_to_latlong(lgt.base, FLAGS.display_res)
+
     print("Running validation")
+    frames_by_cat = {}
     dataloader_validate = tqdm(dataloader_validate)
-    for it, target in enumerate(dataloader_validate):
-
-        # Mix validation background
-        target = prepare_batch(target, 'white')
-
-        result_image, result_dict = validate_itr(glctx, target, geometry, opt_material, lgt, FLAGS, relight)
-        for k in result_dict.keys():
-            np_img = result_dict[k].detach().cpu().numpy()
-            if k == 'shaded':
-                util.save_image(shaded_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
-            elif k == 'relight':
-                util.save_image(relight_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
-            elif k == 'kd':
-                util.save_image(kd_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
-            elif k == 'ks':
-                util.save_image(ks_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
-            elif k == 'normal':
-                util.save_image(normal_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
-            elif k == 'mask':
-                util.save_image(mask_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
+    # PNG encoding runs on worker threads so it overlaps with rendering the next view
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for it, target in enumerate(dataloader_validate):
+
+            # Mix validation background
+            target = prepare_batch(target, 'white')
+
+            result_image, result_dict = validate_itr(glctx, target, geometry, opt_material, lgt, FLAGS, relight, light_latlong)
+            # Issue all device to host copies, then wait for them once
+            cpu_dict = {k: result_dict[k].detach().to('cpu', non_blocking=True) for k in result_dict.keys()}
+            torch.cuda.current_stream().synchronize()
+            for k in cpu_dict.keys():
+                for b in range(cpu_dict[k].shape[0]):
+                    idx = it * batch_size + b
+                    np_img = cpu_dict[k][b].numpy()
+                    if k in ['shaded', 'relight', 'kd', 'ks', 'normal', 'mask']:
+                        # Same quantization as util.save_image, so the GIF matches the saved frames
+                        frame = np.clip(np.rint(np_img * 255.0), 0, 255).astype(np.uint8)
+                        frames_by_cat.setdefault(k, []).append(frame[..., 0] if frame.shape[-1] == 1 else frame)
+                    if k == 'shaded':
+                        pool.submit(util.save_image, shaded_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
+                    elif k == 'relight':
+                        pool.submit(util.save_image, relight_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
+                    elif k == 'kd':
+                        pool.submit(util.save_image, kd_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
+                    elif k == 'ks':
+                        pool.submit(util.save_image, ks_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
+                    elif k == 'normal':
+                        pool.submit(util.save_image, normal_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
+                    elif k == 'mask':
+                        pool.submit(util.save_image, mask_dir + '/' + ('val_%06d_%s.png' % (idx, k)), np_img)
     if 'shaded' in result_dict.keys():
-        save_gif(shaded_dir,30)
+        save_gif(shaded_dir,30,frames_by_cat['shaded'])
     if 'relight' in result_dict.keys():
-        save_gif(relight_dir,30)
+        save_gif(relight_dir,30,frames_by_cat['relight'])
     if 'kd' in result_dict.keys():
-        save_gif(kd_dir,30)
+        save_gif(kd_dir,30,frames_by_cat['kd'])
     if 'ks' in result_dict.keys():
-        save_gif(ks_dir,30)
+        save_gif(ks_dir,30,frames_by_cat['ks'])
     if 'normal' in result_dict.keys():
-        save_gif(normal_dir,30)
+        save_gif(normal_dir,30,frames_by_cat['normal'])
     if 'mask' in result_dict.keys():
-        save_gif(mask_dir,30)
+        save_gif(mask_dir,30,frames_by_cat['mask'])
     return 0
 
 ###############################################################################
@@ -222,6 +312,14 @@ class Trainer(torch.nn.Module):
         self.params = list(self.material.parameters())
         self.params += list(self.light.parameters()) if optimize_light else []
         self.geo_params = list(self.geometry.parameters()) if optimize_geometry else []
+        # Frozen tensors (e.g. the env light base) never get a gradient, keep them out of the optimizer
+        self.params = [p for p in self.params if p.requires_grad]
+        self.geo_params = [p for p in self.geo_params if p.requires_grad]
+
+        # Only the UNet is compiled: tick branches on the Python iteration count and calls into
+        # nvdiffrast / tiny-cuda-nn, while the UNet gets fixed-shape tensors on every step
+        if FLAGS.compile and hasattr(torch, 'compile'):
+            self.stable_diffusion.unet = torch.compile(self.stable_diffusion.unet, mode='reduce-overhead', dynamic=False)
       
 
     def forward(self, target, it, if_normal, if_pretrain, scene_and_vertices ):
@@ -248,13 +346,19 @@ def optimize_mesh(
     scene_and_vertices = None,
     ):
     
-    dataloader_train    = torch.utils.data.DataLoader(dataset_train, batch_size=FLAGS.batch, collate_fn=dataset_train.collate, shuffle=False)
-    dataloader_validate = torch.utils.data.DataLoader(dataset_validate, batch_size=1, collate_fn=dataset_train.collate)
+    worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if FLAGS.num_workers > 0 else {}
+    dataloader_train    = torch.utils.data.DataLoader(dataset_train, batch_size=FLAGS.batch, collate_fn=dataset_train.collate, shuffle=False,
+                                                      pin_memory=True, num_workers=FLAGS.num_workers, **worker_kwargs)
+    dataloader_validate = torch.utils.data.DataLoader(_InfValidate(dataset_validate), batch_size=1, collate_fn=dataset_validate.collate)
+    copy_stream = torch.cuda.Stream()
+    dataloader_train = CudaPrefetcher(dataloader_train, copy_stream)
    
     model = Trainer(glctx, geometry, lgt, opt_material, optimize_geometry, optimize_light, FLAGS, stable_diffusion)
+    # Single-kernel AdamW update when available (PyTorch 2.0+), multi-tensor update otherwise
+    adamw_kwargs = {'fused': True} if 'fused' in inspect.signature(torch.optim.AdamW).parameters else {'foreach': True}
     if optimize_geometry: 
-        optimizer_mesh = torch.optim.AdamW(model.geo_params, lr=0.001, betas=(0.9, 0.99), eps=1e-15)
-    optimizer = torch.optim.AdamW(model.params, lr=0.01, betas=(0.9, 0.99), eps=1e-15)
+        optimizer_mesh = torch.optim.AdamW(model.geo_params, lr=0.001, betas=(0.9, 0.99), eps=1e-15, **adamw_kwargs)
+    optimizer = torch.optim.AdamW(model.params, lr=0.01, betas=(0.9, 0.99), eps=1e-15, **adamw_kwargs)
     if FLAGS.multi_gpu: 
         model = model.cuda()
         model = torch.nn.parallel.DistributedDataParallel(model,
@@ -266,50 +370,52 @@ def optimize_mesh(
     img_loss_vec = []
     reg_loss_vec = []
     iter_dur_vec = []
+    log_interval = 10
+    start_evt, end_evt = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+    loss_buf = torch.zeros(2, log_interval, dtype=torch.float32, device='cuda') # img / reg losses, kept on the GPU until logged
    
 
-    def cycle(iterable):
-        iterator = iter(iterable)
-        while True:
-            try:
-                yield next(iterator)
-            except StopIteration:
-                iterator = iter(iterable)
+    v_it = iter(dataloader_validate)
+    # BF16 has the FP32 exponent range, so the loss scaler is only needed for FP16
+    scaler = torch.cuda.amp.GradScaler(enabled= stable_diffusion.dtype == torch.float16)  
 
-    v_it = cycle(dataloader_validate)
-    scaler = torch.cuda.amp.GradScaler(enabled=True)  
+    # Flags read on every iteration
+    local_rank = FLAGS.local_rank
+    save_interval = FLAGS.save_interval
+    train_background = FLAGS.train_background
+    coarse_iter = FLAGS.coarse_iter
 
-    if FLAGS.local_rank == 0:
+    if local_rank == 0:
         dataloader_train = tqdm(dataloader_train)
     for it, target in enumerate(dataloader_train):
 
         # Mix randomized background into dataset image
-        target = prepare_batch(target, FLAGS.train_background, it, FLAGS.coarse_iter)  
+        target = prepare_batch(target, train_background, it, coarse_iter)  
 
         # ==============================================================================================
         #  Display / save outputs. Do it before training so we get initial meshes
         # ==============================================================================================
 
         # Show/save image before training step (want to get correct rendering of input)
-        if FLAGS.local_rank == 0:
-            save_image = FLAGS.save_interval and (it % FLAGS.save_interval == 0)
+        if local_rank == 0:
+            save_image = save_interval and (it % save_interval == 0)
             if  save_image:
-                result_image, result_dict = validate_itr(glctx, prepare_batch(next(v_it), FLAGS.train_background), geometry, opt_material, lgt, FLAGS)  #prepare_batch(next(v_it), FLAGS.background)
-                np_result_image = result_image.detach().cpu().numpy()
+                result_image, result_dict = validate_itr(glctx, prepare_batch(next(v_it), train_background), geometry, opt_material, lgt, FLAGS)  #prepare_batch(next(v_it), FLAGS.background)
+                np_result_image = result_image[0].detach().cpu().numpy()
                 util.save_image(FLAGS.out_dir + '/' + ('img_%s_%06d.png' % ("appearance_modeling", img_cnt)), np_result_image)
                 img_cnt = img_cnt+1
                     
-        iter_start_time = time.time()
+        start_evt.record()
         if_pretrain = False
         if_normal = False
         
-        with torch.cuda.amp.autocast(enabled= True):
-            if if_pretrain== True:
-                reg_loss = model(target, it, if_normal, if_pretrain= if_pretrain, scene_and_vertices = scene_and_vertices)
-                img_loss = 0 
-                sds_loss = 0 
-            if if_pretrain == False:
-                sds_loss,img_loss, reg_loss = model(target, it, if_normal, if_pretrain= if_pretrain, scene_and_vertices =None)
+        # Mixed precision is only enabled around the Stable Diffusion calls, the rasterizer stays in FP32
+        if if_pretrain== True:
+            reg_loss = model(target, it, if_normal, if_pretrain= if_pretrain, scene_and_vertices = scene_and_vertices)
+            img_loss = 0 
+            sds_loss = 0 
+        if if_pretrain == False:
+            sds_loss,img_loss, reg_loss = model(target, it, if_normal, if_pretrain= if_pretrain, scene_and_vertices =None)
     
         # ==============================================================================================
         #  Final loss
@@ -323,9 +429,9 @@ def optimize_mesh(
             
         if if_pretrain == False:
             scaler.scale(total_loss).backward()
-            img_loss_vec.append(img_loss.item())
+            loss_buf[0, it % log_interval] = img_loss.detach().squeeze()
 
-        reg_loss_vec.append(reg_loss.item())
+        loss_buf[1, it % log_interval] = reg_loss.detach().squeeze()
 
         # ==============================================================================================
         #  Backpropagate
@@ -333,12 +439,12 @@ def optimize_mesh(
 
         if if_normal == False and  if_pretrain == False:
             scaler.step(optimizer)
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
           
         if if_normal == True or if_pretrain == True:
             if optimize_geometry:
                 scaler.step(optimizer_mesh)
-                optimizer_mesh.zero_grad()
+                optimizer_mesh.zero_grad(set_to_none=True)
                 
 
         scaler.update()
@@ -353,20 +459,25 @@ def optimize_mesh(
             if 'normal' in opt_material:
                 opt_material['normal'].clamp_()
                 opt_material['normal'].normalize_()
-            if lgt is not None:
+            if lgt is not None and optimize_light:
                 lgt.clamp_(min=0.0)
 
-        torch.cuda.current_stream().synchronize()
-        iter_dur_vec.append(time.time() - iter_start_time)
+        # Only wait for the GPU once per log window, when the timing and losses are collected
+        end_evt.record()
+        if (it + 1) % log_interval == 0:
+            end_evt.synchronize()
+            iter_dur_vec.append(start_evt.elapsed_time(end_evt) / 1000.0)
+            img_losses, reg_losses = loss_buf.cpu().numpy()
+            img_loss_vec.extend(img_losses)
+            reg_loss_vec.extend(reg_losses)
 
         # ==============================================================================================
         #  Logging
         # ==============================================================================================
-        # log_interval = 10
-        # if it % log_interval == 0 and FLAGS.local_rank == 0 and if_pretrain == False:
+        # if (it + 1) % log_interval == 0 and FLAGS.local_rank == 0 and if_pretrain == False:
         #     img_loss_avg = np.mean(np.asarray(img_loss_vec[-log_interval:]))
         #     reg_loss_avg = np.mean(np.asarray(reg_loss_vec[-log_interval:]))
-        #     iter_dur_avg = np.mean(np.asarray(iter_dur_vec[-log_interval:]))
+        #     iter_dur_avg = iter_dur_vec[-1] # one timed iteration per log window
             
         #     remaining_time = (FLAGS.iter-it)*iter_dur_avg
         #     if optimize_geometry:
@@ -375,8 +486,33 @@ def optimize_mesh(
         #     else:
         #         print("iter=%5d, img_loss=%.6f, reg_loss=%.6f, time=%.1f ms, rem=%s, mat_lr=%.5f" % 
         #             (it, img_loss_avg, reg_loss_avg, iter_dur_avg*1000, util.time_to_text(remaining_time),optimizer.param_groups[0]['lr']))
+
+    # Flush the losses of a last, partially filled log window
+    num_left = (it + 1) % log_interval
+    if num_left > 0:
+        img_losses, reg_losses = loss_buf[:, :num_left].cpu().numpy()
+        img_loss_vec.extend(img_losses)
+        reg_loss_vec.extend(reg_losses)
     return geometry, opt_material
 
+# Read-only view of the parsed flags, slots make the attribute reads in the training loop cheaper
+def freeze_flags(FLAGS):
+    names = list(vars(FLAGS).keys())
+    TrainConfig = dataclasses.make_dataclass('TrainConfig', names, namespace={'__slots__': tuple(names), '__reduce__': _reduce_flags}, frozen=True)
+    return TrainConfig(**vars(FLAGS))
+
+# TrainConfig is generated at runtime, so it is pickled (e.g. for spawned DataLoader workers) by
+# its values and rebuilt on load. The cuda material bounds stay in the main process.
+def _reduce_flags(self):
+    flags = {}
+    for field in dataclasses.fields(self):
+        value = getattr(self, field.name)
+        flags[field.name] = None if torch.is_tensor(value) and value.is_cuda else value
+    return (freeze_flags, (argparse.Namespace(**flags),))
+
+def get_amp_dtype():
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
 def seed_everything(seed, local_rank):
     random.seed(seed + local_rank)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -426,6 +562,8 @@ if __name__ == "__main__":
     parser.add_argument("--if_use_bump", type=bool, default= True , help="whether to use perturbed normals during appearing modeling")
     parser.add_argument("--uv_padding_block", type= int, default= 4 , help="The block of uv padding.")
     parser.add_argument("--negative_text", type=str, default="", help="adding negative text can improve the visual quality in appearance modeling")
+    parser.add_argument("--compile", action='store_true', default=False, help="torch.compile the Stable Diffusion UNet used for the SDS loss. Requires PyTorch 2.0 or newer, ignored otherwise.")
+    parser.add_argument("--num_workers", type=int, default=4, help="The number of DataLoader workers generating training cameras.")
     FLAGS = parser.parse_args()
     FLAGS.mtl_override        = None                     # Override material of model
     FLAGS.dmtet_grid          = 64                       # Resolution of initial tet grid. We provide 64, 128 and 256 resolution grids. Other resolutions can be generated with https://github.com/crawforddoran/quartet
@@ -472,6 +610,8 @@ if __name__ == "__main__":
         print("---------")
 
     seed_everything(FLAGS.seed, FLAGS.local_rank)
+    _materialize_bounds(FLAGS)
+    FLAGS = freeze_flags(FLAGS)
     
     os.makedirs(FLAGS.out_dir, exist_ok=True)
     # Rasterization : 벡터 그래픽 형식으로 설명된 이미지를 래스터 이미지로 변환
@@ -503,7 +643,8 @@ if __name__ == "__main__":
                                sds_weight_strategy = FLAGS.sds_weight_strategy,
                                early_time_step_range = FLAGS.early_time_step_range,
                                late_time_step_range= FLAGS.late_time_step_range,
-                               negative_text = FLAGS.negative_text)
+                               negative_text = FLAGS.negative_text,
+                               dtype = get_amp_dtype())
     stable_diffusion.eval()
     for p in stable_diffusion.parameters():
         p.requires_grad_(False)
@@ -540,7 +681,6 @@ if __name__ == "__main__":
         validate(glctx, geometry, predicted_material, lgt, dataset_gif, os.path.join(FLAGS.out_dir, "validate"), FLAGS, relight)
     if FLAGS.local_rank == 0:
         base_mesh = xatlas_uvmap(glctx, geometry, predicted_material, FLAGS)
-    torch.cuda.empty_cache()
     predicted_material['kd_ks_normal'].cleanup()
     del predicted_material['kd_ks_normal']
     lgt = lgt.clone()